@@ -1,11 +1,30 @@
 """
 Query raster data for links in Antwerp, Belgium.
 
-This method uses ``proppy.raster`` and ``multiprocessing``.
+This method uses ``proppy.raster`` and a thread pool. Raster reads and the
+sampling kernel release the GIL, so threads share one process and avoid
+pickling rectangles. Pass ``use_threads=False`` to use ``multiprocessing``.
+
+Threads share the raster opened lazily with ``rioxarray`` in blocks of
+``1024 x 1024`` pixels; only blocks overlapping the rectangles are read.
+
+Rectangles are stored as a struct of arrays, sorted such that consecutive
+index ranges are spatially compact. Workers are handed ``(start, stop)``
+index ranges; process workers read the arrays from shared memory.
+
+The DSM is expected as a Cloud-Optimized GeoTIFF (tiled, with overviews), so
+that the GDAL block cache of each worker can serve repeated reads. Convert the
+original raster once with ``rio-cogeo``::
+
+    rio cogeo create dsm-1m-clipped.tif dsm-1m-clipped-cog.tif --cog-profile lzw
 """
 
+import gc
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 from time import perf_counter
 
 import geopandas as gpd
@@ -17,10 +36,67 @@ import rioxarray as rxr
 import proppy.raster as prs
 
 
-def load_and_process(relative_buffer=0.5, ncols=100, nrows=20):
+def share_arrays(arrays):
+    """Copy a dict of arrays to shared memory.
+
+    Returns the shared memory blocks, and specs ``(name, shape, dtype)`` from
+    which workers can reconstruct the arrays.
+    """
+    blocks, specs = [], {}
+    for key, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        blocks.append(shm)
+        specs[key] = (shm.name, arr.shape, arr.dtype.str)
+
+    return blocks, specs
+
+
+def work(index_range, arrays, out, nrows, ncols, rasterfile):
+    """Write raster values for the rectangles in ``index_range`` into ``out``."""
+    start, stop = index_range
+
+    prs.normalized_raster_arrays(
+        arrays["bounds"][start:stop],
+        arrays["angles"][start:stop],
+        arrays["consts"][start:stop],
+        arrays["slopes"][start:stop],
+        nrows,
+        ncols,
+        rasterfile,
+        out=out[start:stop],
+    )
+
+
+def work_shared(index_range, specs, out_spec, nrows, ncols, rasterfile):
+    """Query raster values for ``index_range`` of arrays in shared memory.
+
+    Values are written into the shared output array, nothing is returned.
+    """
+    start, stop = index_range
+
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arrays[key] = view[start:stop].copy()
+        del view
+        shm.close()
+
+    name, shape, dtype = out_spec
+    shm = shared_memory.SharedMemory(name=name)
+    out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    work((0, stop - start), arrays, out[start:stop], nrows, ncols, rasterfile)
+    del out
+    shm.close()
+
+
+def load_and_process(
+    relative_buffer=0.5, ncols=100, nrows=20, chunksize=64, use_threads=True
+):
     # input data files
     links_file = "/Users/sander/Desktop/lora-tools/antwerp_links.geojson"
-    path_raster = "/Volumes/Transcend/lora/data/antwerp-gis/dsm-1m-clipped.tif"
+    path_raster = "/Volumes/Transcend/lora/data/antwerp-gis/dsm-1m-clipped-cog.tif"
 
     # Load link data from file
     links = gpd.read_file(links_file)
@@ -33,40 +109,89 @@ def load_and_process(relative_buffer=0.5, ncols=100, nrows=20):
     lines = links.geometry
     zheads, ztails = links["ele_tr"].values, links["ele_gw"].values
 
-    # Compute rectangle features
-    buffers = lengths * relative_buffer
-    angles = prs.angle(lines)
-    rects = prs.makeParallelRectangles(lines.values, angles, buffers)
-    consts, slopes = prs.getSlope(lines, angles, zheads, ztails)
+    rects = prs.make_rectangles(lines, zheads, ztails, buffer=lengths * relative_buffer)
 
-    # Form Rectangle-objects
-    rectangles = []
-    for i, _ in enumerate(rects):
-        R = prs.Rectangle(i, rects[i], angles[i], consts[i], slopes[i], lengths[i])
-        rectangles.append(R)
+    # Struct of arrays, sorted so that index ranges are spatially compact
+    bounds = rects.bounds
+    order = prs.spatial_order(bounds)
+    arrays = {
+        "ids": rects.ids[order],
+        "bounds": bounds[order],
+        "angles": rects.angles[order],
+        "consts": rects.consts[order],
+        "slopes": rects.slopes[order],
+    }
 
-    # Main "loop" using multiprocessing
+    # free intermediates before starting workers
+    del links, lines, rects, bounds, lengths, zheads, ztails
+    gc.collect()
+
+    n = len(order)
+    ranges = [(k, min(k + chunksize, n)) for k in range(0, n, chunksize)]
+
+    # Main "loop" using a thread or process pool
     fun_kwargs = {"nrows": nrows, "ncols": ncols, "rasterfile": path_raster}
 
     t_start = perf_counter()  # time run
 
-    with Pool() as p:
-        out = p.map(partial(prs.normalized_raster_values, **fun_kwargs), rectangles)
+    # Output in sorted order, so workers write contiguous rows
+    shape = (n, nrows * ncols)
+
+    if use_threads:
+        # Threads share one lazily loaded, chunked raster
+        fun_kwargs["rasterfile"] = rxr.open_rasterio(
+            path_raster, chunks={"x": 1024, "y": 1024}, lock=False
+        ).squeeze()
+
+        sorted_vals = np.empty(shape)
+        worker = partial(work, arrays=arrays, out=sorted_vals, **fun_kwargs)
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            list(ex.map(worker, ranges))
+    else:
+        # Each worker opens the raster once and keeps it open
+        blocks, specs = share_arrays(arrays)
+        out_shm = shared_memory.SharedMemory(create=True, size=max(n, 1) * 8 * shape[1])
+        blocks.append(out_shm)
+        out_spec = (out_shm.name, shape, "<f8")
+
+        try:
+            # send several index ranges per IPC round-trip
+            pool_chunksize = max(1, len(ranges) // (4 * os.cpu_count()))
+
+            with Pool(initializer=prs.init_worker, initargs=(path_raster,)) as p:
+                worker = partial(
+                    work_shared, specs=specs, out_spec=out_spec, **fun_kwargs
+                )
+                list(p.imap_unordered(worker, ranges, chunksize=pool_chunksize))
+
+            sorted_vals = np.ndarray(shape, dtype="<f8", buffer=out_shm.buf).copy()
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    # rows by rectangle id
+    data = np.empty_like(sorted_vals)
+    data[arrays["ids"]] = sorted_vals
 
     t_stop = perf_counter()
     duration = t_stop - t_start
 
-    return out, duration
+    return data, duration
 
 
 if __name__ == "__main__":
+    # workers start from a clean server process, not a copy of this one
+    multiprocessing.set_start_method("forkserver", force=True)
+
     print("-" * 80)
-    print("Querying raster (with multiprocessing)...")
-    out, duration = load_and_process()
+    print("Querying raster (with a thread pool)...")
+    data, duration = load_and_process()
     print(f"Completed in {duration:.1f} seconds.")
 
-    # expand list column and save
-    df = pd.DataFrame.from_records(out, index="id")
-    df = pd.DataFrame(df["data"].to_list(), columns=list(range(len(out[0]["data"]))))
+    # rows are indexed by rectangle id
+    df = pd.DataFrame(data)
+    df.columns = df.columns.astype(str)  # parquet requires string column names
     print(f"Saving dataframe of shape {df.shape}.")
-    df.to_csv("../../data/antwerp_geodata.csv")
+    df.to_parquet("../../data/antwerp_geodata.parquet", compression="zstd")
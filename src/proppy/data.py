@@ -7,7 +7,7 @@ data
   Raw TCAT data is not yet included on git. Find a place to host it and upload.
   Implement a ``DataSet`` class for loading the data, just like ``MNIST`` or ``omniglot``.
 
-Tools for managing proppy datasets for ``PyTorch``. 
+Tools for managing proppy datasets for ``PyTorch``.
 
 Based on PyTorch's
 `data_tutorial <https://pytorch.org/tutorials/beginner/basics/data_tutorial.html#creating-a-custom-dataset-for-your-files>`_.
@@ -30,8 +30,14 @@ from torch.utils.data import Dataset
 class LinkDataset(Dataset):
     """
     Dataset for raster-enhanced wireless links.
+
+    The raster-derived ``.csv``-files are stacked into a single binary file
+    ``raster.npy`` in ``rasterdir`` on first use. This file is memory-mapped,
+    so loading an item reads one row instead of parsing a text file.
     """
 
+    cachefile = "raster.npy"
+
     def __init__(
         self, linkfile, rasterdir, datacols=None, transform=None, target_transform=None
     ):
@@ -52,10 +58,12 @@ class LinkDataset(Dataset):
         """
 
         links = gpd.read_file(linkfile)
-        self.labels = links["succes"]
+
+        # plain arrays, indexing a DataFrame per item is slow
+        self.labels = links["succes"].to_numpy()
 
         if datacols:
-            self.data = links[datacols]
+            self.data = links[datacols].to_numpy()
         else:
             self.data = None
 
@@ -63,20 +71,60 @@ class LinkDataset(Dataset):
         self.transform = transform
         self.target_transform = target_transform
 
+        cache = os.path.join(self.raster_dir, self.cachefile)
+        if self._cache_is_stale(cache):
+            self._prepare_cache()
+        self.raster = np.load(cache, mmap_mode="r")
+
+        if self.raster.shape[0] != len(self):
+            raise ValueError(
+                f"{cache} has {self.raster.shape[0]} rows, expected {len(self)}."
+            )
+
     def __len__(self):
         return len(self.labels)
 
-    def __getitem__(self, idx):
-        label = self.labels.iloc[idx, 1]
+    def _cache_is_stale(self, cache):
+        """Whether ``cache`` is missing, has the wrong number of rows, or is
+        older than any of the raster-derived ``.csv``-files.
+        """
+        if not os.path.exists(cache):
+            return True
+
+        if np.load(cache, mmap_mode="r").shape[0] != len(self):
+            return True
 
-        if self.data:
-            data = self.data.iloc[idx].to_numpy()
+        modified = os.path.getmtime(cache)
+        for idx in range(len(self)):
+            csv = os.path.join(self.raster_dir, f"{idx}.csv")
+            if os.path.exists(csv) and os.path.getmtime(csv) > modified:
+                return True
+
+        return False
+
+    def _prepare_cache(self):
+        """Read all raster-derived ``.csv``-files and save them as one array.
+
+        Row ``idx`` of the saved array holds the flattened values of
+        ``{idx}.csv``.
+        """
+        rastervals = [
+            np.genfromtxt(
+                os.path.join(self.raster_dir, f"{idx}.csv"), delimiter=","
+            ).flatten()
+            for idx in range(len(self))
+        ]
+
+        np.save(os.path.join(self.raster_dir, self.cachefile), np.stack(rastervals))
+
+    def __getitem__(self, idx):
+        label = self.labels[idx]
 
-        rastervals = np.genfromtxt(f"{self.rasterpath}/{idx}.csv", delimiter=",")
-        rastervals = rastervals.flatten()
+        # copy, as the memory-mapped rows are read-only
+        rastervals = np.array(self.raster[idx])
 
-        if self.data:
-            x = np.concatenate(data, rastervals)
+        if self.data is not None:
+            x = np.concatenate((self.data[idx], rastervals))
         else:
             x = rastervals
 
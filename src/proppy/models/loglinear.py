@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 
 """
@@ -41,12 +43,36 @@ class LogLinearPathLoss:
     def __call__(self, dist):
         """Evaluate path loss given distance.
 
+        The evaluation is vectorized, so path loss for many links is best
+        computed with a single call on an array of distances.
+
         Parameters
         ----------
-        dist : float
-            Distance of link in meters.
+        dist : float or array-like
+            Distance(s) of link(s) in meters.
         """
-        return self.const + self.slope * np.log10(dist)
+        return self.const + self.slope * np.log10(np.asarray(dist))
+
+    def batch_eval(self, dists):
+        """Evaluate path loss for an array of distances.
+
+        Computes the same values as calling the model, but in place on a
+        single float array, so no intermediate arrays are allocated.
+
+        Parameters
+        ----------
+        dists : array-like
+            Distances of links in meters.
+
+        Returns
+        -------
+        loss : ndarray
+            Path loss for each distance.
+        """
+        loss = np.log10(np.asarray(dists, dtype=np.float64))
+        loss *= self.slope
+        loss += self.const
+        return loss
 
 
 class FreeSpacePathLoss(LogLinearPathLoss):
@@ -58,18 +84,23 @@ class FreeSpacePathLoss(LogLinearPathLoss):
         Frequency (mHz)
     """
 
+    # Model constants by frequency, precomputed for common LoRa bands
+    _CONST_CACHE = {f: 20 * math.log10(f) - 27.55 for f in (433, 868, 915)}
+
     def __init__(self, frequency):
-        # Compute constant and coefficient
-        const = 20 * np.log10(frequency) - 27.55
+        # Look up or compute constant, and coefficient
+        const = self._CONST_CACHE.get(frequency)
+        if const is None:
+            const = self._CONST_CACHE[frequency] = 20 * math.log10(frequency) - 27.55
         slope = 20
 
         super().__init__("Free-space path loss", const, slope)
-        self.freq = freq
+        self._freq = frequency
 
     @property
     def freq(self):
         """Return frequency used in model"""
-        return self.freq
+        return self._freq
 
 
 class HataPathLoss(LogLinearPathLoss):
@@ -85,7 +116,7 @@ class HataPathLoss(LogLinearPathLoss):
     h_tx : float
         Transmitter height (m)
     kind : str, optional
-        Specifies kind of environment, either "rural", "suburban", or "urban".
+        Specifies kind of environment, either "open", "suburban", or "urban".
     city_size : str, optional
         Size of city, takes values "small", "medium", or "large".
 
@@ -96,38 +127,42 @@ class HataPathLoss(LogLinearPathLoss):
     """
 
     def __init__(self, freq=915, h_rx=30, h_tx=1.5, kind="urban", city_size="small"):
-        if kind not in set("open", "suburban", "urban"):
-            raise ValueError('kind must be "rural", "suburban", or "urban".')
+        if kind not in {"open", "suburban", "urban"}:
+            raise ValueError('kind must be "open", "suburban", or "urban".')
 
-        if city_size not in set("small", "medium", "large"):
+        if city_size not in {"small", "medium", "large"}:
             raise ValueError('city_size must be "small", "medium" or "large".')
 
-        const = 69.55 + 26.16 * np.log10(freq) - 13.82 * np.log10(h_rx)
+        # logarithms are scalars, math.log10 avoids ufunc dispatch
+        log_freq = math.log10(freq)
+        log_h_rx = math.log10(h_rx)
+
+        const = 69.55 + 26.16 * log_freq - 13.82 * log_h_rx
 
         # Height correction (open, suburban, small cities, medium cities)
-        corr = 0.8 + h_tx * (1.1 * np.log10(freq) - 0.7) - 1.56 * np.log10(freq)
+        corr = 0.8 + h_tx * (1.1 * log_freq - 0.7) - 1.56 * log_freq
 
         # adjust antenna height correction factor
         if kind == "urban" and city_size == "large":
             if freq <= 200:
-                corr = 8.5 * np.log10(1.54 * h_tx) ** 2 - 1.1
+                corr = 8.5 * math.log10(1.54 * h_tx) ** 2 - 1.1
             elif freq > 200:
-                corr = 3.2 * np.log10(11.75 * h_tx) ** 2 - 4.97
+                corr = 3.2 * math.log10(11.75 * h_tx) ** 2 - 4.97
 
         const += corr  # add correction factor to constant
 
         # environment type correction
         if kind == "suburban":
             # compute path loss reduction for suburban
-            reduction = 2 * np.log10(freq / 28) ** 2 + 5.4
+            reduction = 2 * math.log10(freq / 28) ** 2 + 5.4
             const -= reduction
 
         elif kind == "open":
             # compute path loss recution for open space
-            reduction = 4.78 * np.log10(freq) ** 2 - 18.33 * np.log10(freq) + 40.94
+            reduction = 4.78 * log_freq**2 - 18.33 * log_freq + 40.94
             const -= reduction
 
-        coeff = 44.9 - 6.55 * np.log10(h_rx)
+        coeff = 44.9 - 6.55 * log_h_rx
 
         const -= 3 * coeff  # as we use m and not km
 
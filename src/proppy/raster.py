@@ -12,17 +12,31 @@ example querying whether two points in space have line of sight. This is
 equivalent to querying wether the line segment connecting the two points
 intersects the terrain. The ``raster``-package is designed to run such queries.
 It also enables the querying of richer data for line-segments. The module uses
-``multiprocessing`` to process multiple queries in parallel.
+``multiprocessing`` to process multiple queries in parallel. Queries of many
+nearby rectangles can instead be batched into a single raster read, see
+``batch_mean_obstruction``.
 """
 
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import contextily as cx
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import rasterio as rio
 import shapely
-from shapely.affinity import rotate
-from shapely.geometry import LineString, Point, Polygon, box, mapping
+from numba import njit, prange
+from shapely.affinity import affine_transform
+from shapely.geometry import LineString, Polygon, mapping
+
+# Raster datasets held open by the current thread, see ``_open_raster``.
+# GDAL dataset handles must not be shared between threads or processes.
+_LOCAL = threading.local()
+_MAX_DATASETS = 256
 
 
 class Rectangle:
@@ -63,6 +77,19 @@ class Rectangle:
     a constant and a slope.
     """
 
+    # no per-instance __dict__, as there is one rectangle per line-segment
+    __slots__ = (
+        "id",
+        "poly",
+        "angle",
+        "const",
+        "slope",
+        "length",
+        "points",
+        "point_vals",
+        "_rotated_poly",
+    )
+
     def __init__(self, id, polygon, angle, constant, slope, length):
         """Initialize Rectangle collection."""
         self.id = id
@@ -71,29 +98,55 @@ class Rectangle:
         self.const = constant
         self.slope = slope
         self.length = length
+        self.points = None
+        self.point_vals = None
+        self._rotated_poly = None
 
     def __repr__(self):
-        return f"Rectanlge({self.__dict__})"
+        attrs = {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if not name.startswith("_")
+        }
+        return f"Rectanlge({attrs})"
 
     @property
     def rotated_poly(self):
-        """Return polygon rotated by angle."""
-        return rotate(self.poly, self.angle, "center", use_radians=True)
+        """Return polygon rotated by angle, computed on first access."""
+        if self._rotated_poly is None:
+            self._rotated_poly = affine_transform(self.poly, self.rotation_matrix)
+        return self._rotated_poly
+
+    @property
+    def rotation_matrix(self):
+        """Affine matrix rotating by angle about the center of the polygon.
 
-    def normalize_raster_values(self, points, vals):
+        Given as ``[a, b, d, e, xoff, yoff]`` for ``affine_transform``.
+        """
+        minx, miny, maxx, maxy = self.poly.bounds
+        cx, cy = (minx + maxx) / 2, (miny + maxy) / 2
+        a, b = np.cos(self.angle), -np.sin(self.angle)
+        d, e = -b, a
+
+        return [a, b, d, e, cx - a * cx - b * cy, cy - d * cx - e * cy]
+
+    def normalize_raster_values(self, x, vals):
         """Vertical distance between plane parallel to LoS-line and terrain.
 
         Parameters
         ----------
-        points : geopandas.GeoDataFrame (?)
-            Points at which values were queried.
+        x : np.array
+            The x-coordinates at which values were queried, or the shapely
+            Points themselves.
         vals : np.array
             Raster values at points
         """
 
-        x_values = np.array([point.x for point in points])
+        x = np.asarray(x)
+        if x.dtype == object:
+            x = shapely.get_coordinates(x)[:, 0]
 
-        heights = self.const + self.slope * x_values
+        heights = self.const + self.slope * x
 
         return heights - vals
 
@@ -127,9 +180,7 @@ class Rectangle:
 
         pts = gpd.GeoDataFrame(geometry=self.points)
 
-        pts.geometry = pts.geometry.rotate(
-            self.angle, origin=self.poly.centroid, use_radians=True
-        )
+        pts.geometry = pts.geometry.affine_transform(self.rotation_matrix)
 
         pts = pts.set_crs(points_crs)
         pts = pts.to_crs("EPSG:3857")  # web mercator
@@ -159,8 +210,203 @@ class Rectangle:
         plt.show()
 
 
-def make_rectangles(lines, zheads, ztails, relative_buffer=0.1):
-    """Generate list of rectangles from line-segments and a buffer.
+class Rectangles:
+    """A collection of rectangles stored as a struct of arrays.
+
+    Holds the same attributes as ``Rectangle``, with one array per attribute,
+    such that queries over many rectangles can be vectorized. Indexing with an
+    integer returns a ``Rectangle``, indexing with a slice or array of indices
+    returns a ``Rectangles``-object.
+
+    Attributes
+    ----------
+    ids : ndarray
+        Indices of the rectangles.
+    polys : ndarray
+        Array of axis-parallel shapely rectangles.
+    angles : ndarray
+        Angles for rotating rectangles to original position.
+    consts : ndarray
+        Values of rectangles' tail z-axis position.
+    slopes : ndarray
+        Values of rectangles' z-axis slope.
+    lengths : ndarray
+        Lengths on x-axis of aligned rectangles.
+
+    Notes
+    -----
+    The ``Rectangle``-objects returned by indexing are created on access and
+    do not share state, e.g. their ``points``, with the collection.
+    """
+
+    __slots__ = ("ids", "polys", "angles", "consts", "slopes", "lengths")
+
+    def __init__(self, ids, polygons, angles, constants, slopes, lengths):
+        """Initialize Rectangles collection."""
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.polys = np.asarray(polygons, dtype=object)
+        self.angles = np.asarray(angles, dtype=np.float64)
+        self.consts = np.asarray(constants, dtype=np.float64)
+        self.slopes = np.asarray(slopes, dtype=np.float64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+
+    def __repr__(self):
+        return f"Rectangles(n={len(self)})"
+
+    @classmethod
+    def from_rectangles(cls, rectangles):
+        """Make a Rectangles-object from an iterable of proppy.Rectangle-objects.
+
+        A Rectangles-object is returned as is.
+        """
+        if isinstance(rectangles, cls):
+            return rectangles
+
+        rectangles = list(rectangles)
+
+        return cls(
+            [r.id for r in rectangles],
+            [r.poly for r in rectangles],
+            [r.angle for r in rectangles],
+            [r.const for r in rectangles],
+            [r.slope for r in rectangles],
+            [r.length for r in rectangles],
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        if np.isscalar(idx):
+            return Rectangle(
+                int(self.ids[idx]),
+                self.polys[idx],
+                self.angles[idx],
+                self.consts[idx],
+                self.slopes[idx],
+                self.lengths[idx],
+            )
+
+        return Rectangles(*(getattr(self, name)[idx] for name in self.__slots__))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def bounds(self):
+        """Array of shape ``(N, 4)`` of ``(minx, miny, maxx, maxy)``-bounds."""
+        return shapely.bounds(self.polys)
+
+    @property
+    def rotated_polys(self):
+        """Array of polygons rotated by angles, in their original position."""
+        minx, miny, maxx, maxy = self.bounds.T
+        corners = np.stack(
+            [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy]], axis=1
+        ).transpose(2, 1, 0)
+
+        # rotate about the centers of the rectangles
+        center = np.column_stack([(minx + maxx) / 2, (miny + maxy) / 2])[:, None]
+        cos = np.cos(self.angles)[:, None]
+        sin = np.sin(self.angles)[:, None]
+        dx, dy = (corners - center).transpose(2, 0, 1)
+        rotated = center + np.stack([cos * dx - sin * dy, sin * dx + cos * dy], axis=-1)
+
+        return shapely.polygons(rotated)
+
+    def normalize_raster_values(self, x, vals):
+        """Vertical distance between planes parallel to LoS-lines and terrain.
+
+        Parameters
+        ----------
+        x : np.array
+            The x-coordinates at which values were queried, of shape ``(N, M)``
+            or ``(M,)`` for ``M`` points in each of the ``N`` rectangles.
+        vals : np.array
+            Raster values at the points, of shape ``(N, M)``.
+
+        Returns
+        -------
+        distances : np.array
+            Array of shape ``(N, M)``.
+        """
+
+        heights = self.consts[:, None] + self.slopes[:, None] * np.asarray(x)
+
+        return heights - vals
+
+    def obstruction_fraction(self, x, vals):
+        """Fraction of points of each rectangle that lie below the terrain.
+
+        Parameters
+        ----------
+        x : np.array
+            The x-coordinates at which values were queried, see
+            ``normalize_raster_values``.
+        vals : np.array
+            Raster values at the points, of shape ``(N, M)``.
+
+        Returns
+        -------
+        fractions : np.array
+            Array of length ``N``.
+        """
+
+        return np.mean(self.normalize_raster_values(x, vals) < 0, axis=1)
+
+
+class RectangleIndex:
+    """A spatial index over a collection of rectangles.
+
+    Wraps a ``shapely.STRtree`` to find the rectangles containing many points,
+    e.g. raster pixel centers, in a single query.
+
+    Attributes
+    ----------
+    polys : ndarray
+        Array of (prepared) indexed polygons.
+    tree : shapely.STRtree
+        Tree over ``polys``.
+    """
+
+    def __init__(self, rectangles, rotated=True):
+        """Build the index.
+
+        Parameters
+        ----------
+        rectangles : Rectangles
+            Rectangles to index.
+        rotated : bool, optional
+            Whether to index rectangles in their original position, rather
+            than their axis-parallel polygons.
+        """
+        self.polys = rectangles.rotated_polys if rotated else rectangles.polys.copy()
+        shapely.prepare(self.polys)
+        self.tree = shapely.STRtree(self.polys)
+
+    def query_points(self, xy):
+        """Find the rectangles containing points.
+
+        Parameters
+        ----------
+        xy : np.array
+            Array of shape ``(M, 2)`` of point coordinates.
+
+        Returns
+        -------
+        rect_idx, pt_idx : np.array
+            Positions of rectangles, and of points within them, such that
+            rectangle ``rect_idx[k]`` contains point ``pt_idx[k]``.
+        """
+        pt_idx, rect_idx = self.tree.query(shapely.points(xy), predicate="within")
+
+        return rect_idx, pt_idx
+
+
+def make_rectangles(
+    lines, zheads, ztails, relative_buffer=0.1, max_length=None, buffer=None
+):
+    """Generate a Rectangles-collection from line-segments and a buffer.
 
     Parameters
     ----------
@@ -172,30 +418,58 @@ def make_rectangles(lines, zheads, ztails, relative_buffer=0.1):
       Array of z-coordinates of line-segment tails.
     relative_buffer : float
       Distance from centerline of to edge of rectangle as function of line-length.
+    max_length : float, optional
+      If given, line-segments longer than ``max_length`` are skipped. The
+      rectangle ``id`` remains the position of the line-segment in ``lines``.
+    buffer : float or array-like, optional
+      Distance from centerline to edge of rectangle for each line-segment. If
+      given, this is used instead of ``relative_buffer``.
 
     Returns
     -------
-    rectangles : list
-      List of proppy.Rectangle-objects.
+    rectangles : Rectangles
+      Collection of rectangles, not a list. Indexing returns a new
+      proppy.Rectangle-object on each access, so attributes set on it, such
+      as ``points`` and ``point_vals``, are not kept in the collection; keep
+      a reference to the ``Rectangle`` instead, e.g. ``rects = list(rects)``.
     """
 
-    lengths = lines.geometry.length
-
-    buffers = lengths * relative_buffer
-
-    angles = angle(lines)
-
-    polygons = makeParallelRectangles(lines.values, angles, buffers)
-
-    consts, slopes = getSlope(lines, angles, zheads, ztails)
+    # coordinates are extracted once, all else is computed from this array
+    coords = lineCoords(lines.geometry.values)
+    heads, tails = coords[:, 0], coords[:, 1]
+    dx, dy = (tails - heads).T
+
+    lengths = np.hypot(dx, dy)
+    ids = np.arange(len(lengths))
+
+    if buffer is None:
+        buffers = lengths * relative_buffer
+    else:
+        buffers = np.broadcast_to(np.asarray(buffer, dtype=np.float64), lengths.shape)
+
+    # drop long lines before any geometry is computed
+    if max_length is not None:
+        ids = np.nonzero(lengths <= max_length)[0]
+        heads, tails, lengths = heads[ids], tails[ids], lengths[ids]
+        dx, dy, buffers = dx[ids], dy[ids], buffers[ids]
+        zheads, ztails = np.asarray(zheads)[ids], np.asarray(ztails)[ids]
+
+    angles = np.arctan2(dy, dx)
+
+    # lines rotated about their midpoints to be axis-parallel span the x-axis
+    # from mid - length / 2 to mid + length / 2; buffering adds to all sides
+    mid = (heads + tails) / 2
+    xheads = mid[:, 0] - lengths / 2
+    polygons = shapely.box(
+        xheads - buffers,
+        mid[:, 1] - buffers,
+        mid[:, 0] + lengths / 2 + buffers,
+        mid[:, 1] + buffers,
+    )
 
-    # Form Rectangle-objects
-    rectangles = []
-    for i, poly in enumerate(polygons):
-        R = Rectangle(i, poly, angles[i], consts[i], slopes[i], lengths[i])
-        rectangles.append(R)
+    consts, slopes = getSlopeArray(zheads, ztails, lengths, xheads)
 
-    return rectangles
+    return Rectangles(ids, polygons, angles, consts, slopes, lengths)
 
 
 def makeLineString(A, B):
@@ -213,24 +487,27 @@ def makeLineString(A, B):
     return LineString([(A.x, A.y), (B.x, B.y)])
 
 
-def makeGrid(shape, step):
+def makeGrid(shape, step, inside_only=False):
     """
     Make a uniform array of (x,y)-coordinates over the envelope of ``shape``.
 
     Works best on axis-parallel rectangles, otherwise there may be points that
-    are in the envelope but not in the shape itself. In this case one can
-    collecct the points inside the ``shape``  by converting the reurned
-    ``pointCoords` to  shapely ``Points`` and use `Points.within(shape)` in
-    ``geopandas``.
+    are in the envelope but not in the shape itself. In this case pass
+    ``inside_only=True`` to keep only the points inside the ``shape``; this
+    tests all coordinates at once against the prepared shape, and is much
+    faster than making shapely ``Points`` and using ``Points.within(shape)``.
 
     Parameters
     ----------
-    shape : shapely.Polygon
-        A 2D shape whose envelope will be populated by points.
+    shape : geopandas.GeoSeries or geopandas.GeoDataFrame
+        Holding a 2D shape whose envelope will be populated by points.
 
     step : float
         Axis-parallel distance between points in grid
 
+    inside_only : bool, optional
+        Whether to drop points that are not inside the ``shape``.
+
     Returns
     _______
     pointCoords : ndarray
@@ -239,34 +516,50 @@ def makeGrid(shape, step):
 
     minx, miny, maxx, maxy = shape.geometry.envelope.bounds.values[0]
 
-    Xs = np.arange(minx, maxx, step=step)
-    Ys = np.arange(miny, maxy, step=step)
+    Xs = np.arange(minx, maxx, step=step, dtype=np.float64)
+    Ys = np.arange(miny, maxy, step=step, dtype=np.float64)
 
-    pointCoords = np.array(np.meshgrid(Xs, Ys)).T.reshape(-1, 2)
+    # x outer, y inner, broadcast into one contiguous (N, 2) array
+    pointCoords = np.empty((Xs.size * Ys.size, 2), dtype=np.float64)
+    grid = pointCoords.reshape(Xs.size, Ys.size, 2)
+    grid[:, :, 0] = Xs[:, None]
+    grid[:, :, 1] = Ys
 
-    return pointCoords
+    if inside_only:
+        geom = shape.geometry.iloc[0]
+        shapely.prepare(geom)
+        mask = shapely.contains_xy(geom, pointCoords[:, 0], pointCoords[:, 1])
+        pointCoords = pointCoords[mask]
 
+    return pointCoords
 
-def _angle(xHead, yHead, xTail, yTail):
-    """
-    The angle of a 2D line going from Head to Tail.
 
-    The inputs are cartesian coordinates.
+def lineCoords(lines):
     """
+    Extract head and tail coordinates of line-segments as a single array.
 
-    radii = np.full_like(xHead, np.nan, dtype=np.float32)
+    Extracting coordinates once and passing the array to ``angle`` and
+    ``makeParallelRectangles`` avoids traversing the geometries repeatedly.
 
-    equalX = np.isclose(xHead, xTail)
-
-    if np.any(equalX):
-        radii[equalX] = np.where(yHead[equalX] > yTail[equalX], -np.pi / 2, np.pi / 2)
-
-    rise = yTail[~equalX] - yHead[~equalX]
-    run = xTail[~equalX] - xHead[~equalX]
+    Parameters
+    ----------
+    lines : geopandas.GeoSeries, geopandas.GeoDataFrame or ndarray
+        LineStrings of exactly two points (head, tail) each. An array of
+        coordinates is returned reshaped.
 
-    radii[~equalX] = np.arctan(rise / run)
+    Returns
+    -------
+    coords : ndarray
+        Array of shape ``(N, 2, 2)``, where ``coords[i, 0]`` and ``coords[i, 1]``
+        are the (x, y)-coordinates of the head and tail of line ``i``.
+    """
+    coords = np.asarray(getattr(lines, "geometry", lines))
+    if coords.dtype == object:
+        if np.any(shapely.get_num_coordinates(coords) != 2):
+            raise ValueError("Input `lines` must have exactly two points each.")
+        coords = shapely.get_coordinates(coords)
 
-    return radii
+    return coords.reshape(-1, 2, 2)
 
 
 def angle(lines):
@@ -279,26 +572,48 @@ def angle(lines):
 
     Parameters
     ----------
-    lines : `geopandas.geoseries.GeoSeries`
-        Should be only `lineString`-objects with exactly 2 points each.
+    lines : `geopandas.geoseries.GeoSeries` or ndarray
+        Should be only `lineString`-objects with exactly 2 points each, or
+        their coordinates as returned by ``lineCoords``.
 
     Returns
     -------
     angles : ndarray
-        LineString angles in the (x,y)-plane.
+        LineString angles in the (x,y)-plane, in radians in ``[-pi, pi]``.
 
     """
-    xHead = np.array([line.boundary.geoms[0].x for line in lines.geometry])
-    yHead = np.array([line.boundary.geoms[0].y for line in lines.geometry])
-    xTail = np.array([line.boundary.geoms[1].x for line in lines.geometry])
-    yTail = np.array([line.boundary.geoms[1].y for line in lines.geometry])
+    coords = lineCoords(lines)
+
+    dx = coords[:, 1, 0] - coords[:, 0, 0]
+    dy = coords[:, 1, 1] - coords[:, 0, 1]
 
-    # compute angle (in y=0 plain)
-    angles = _angle(xHead, yHead, xTail, yTail)
+    return np.arctan2(dy, dx)
 
-    angles[xHead > xTail] += np.pi  # align rotation
 
-    return angles
+def _rotate_lines(coords, angles):
+    """Rotate line coordinates by ``-angles`` about the lines' midpoints.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Line coordinates of shape ``(N, 2, 2)``, see ``lineCoords``.
+    angles : np.array
+        Array of line angles in radians.
+
+    Returns
+    -------
+    rotated : ndarray
+        Coordinates of shape ``(N, 2, 2)`` of the axis-parallel lines.
+    """
+
+    mid = coords.mean(axis=1, keepdims=True)
+    cos = np.cos(-np.asarray(angles))[:, None]
+    sin = np.sin(-np.asarray(angles))[:, None]
+    dx, dy = coords[..., 0] - mid[..., 0], coords[..., 1] - mid[..., 1]
+
+    return np.stack(
+        [mid[..., 0] + cos * dx - sin * dy, mid[..., 1] + sin * dx + cos * dy], axis=-1
+    )
 
 
 def makeParallelRectangles(lines, angles, buffer):
@@ -309,13 +624,14 @@ def makeParallelRectangles(lines, angles, buffer):
     ------
     The rectangles are generated by first rotating
     each line to be orthogonal to the x-axis. For an axis-aligned line, an
-    axis-parallel rectangle is created by buffering the line and taking the
-    envelope of the resulting sausage-like shape.
+    axis-parallel rectangle is the envelope of the buffered, sausage-like
+    shape, which is computed directly from the line's coordinates.
 
     Parameters
     ----------
-    lines : geopandas.array.GeometryArray
-        Array of 2D lines (``lineString``) of length ``nLines``.
+    lines : geopandas.array.GeometryArray or ndarray
+        Array of 2D lines (``lineString``) of length ``nLines``, or their
+        coordinates as returned by ``lineCoords``.
     angles : np.array
         Array of line angles in radinas.
     buffers : array-like
@@ -323,27 +639,26 @@ def makeParallelRectangles(lines, angles, buffer):
 
     Returns
     -------
-    rects : A list of `nLines` orthogonal rectangles.
+    rects : An array of `nLines` orthogonal rectangles.
     """
 
-    # if scalar buffer make array
-    if not hasattr(buffer, "__len__"):
-        buffer = np.repeat(buffer, len(lines))
-
     nLines = len(lines)
 
-    lines_parallel = [
-        rotate(lines[i], -angles[i], use_radians=True) for i in range(nLines)
-    ]
+    # if scalar buffer make array
+    buffer = np.broadcast_to(np.asarray(buffer, dtype=np.float64), (nLines,))
 
-    sausages = [lines_parallel[i].buffer(buffer[i]) for i in range(nLines)]
+    rotated = _rotate_lines(lineCoords(lines), angles)
 
-    rects = [box(*sausages[i].bounds) for i in range(nLines)]
+    # lines are horizontal, so the envelope of the sausage extends each line
+    # by the buffer on all sides
+    xs, y = rotated[..., 0], rotated[:, :, 1].mean(axis=1)
 
-    return rects
+    return shapely.box(
+        xs.min(axis=1) - buffer, y - buffer, xs.max(axis=1) + buffer, y + buffer
+    )
 
 
-def getSlope(lines, angles, zHeads, zTails):
+def getSlope(lines, angles, zHeads, zTails, lengths=None):
     """
     Compute slopes and constants for a lineSegments.
 
@@ -352,14 +667,17 @@ def getSlope(lines, angles, zHeads, zTails):
 
     Parameters
     ----------
-    lines : geopandas.geoseries.GeoSeries
-        Series of LineStrings of exactly two points (head, tail) each.
+    lines : geopandas.geoseries.GeoSeries or ndarray
+        Series of LineStrings of exactly two points (head, tail) each, or
+        their coordinates as returned by ``lineCoords``.
     angles : np.array
        Angles by which rotating makes `lines` axis-parallel.
     zHead : array_like
         Array of z-coordinates at the heads of the line segments.
     zTail : array_like
         Array of z-coordinates at the tails of the line segments.
+    lengths : array_like, optional
+        Array of (2D) lengths of the line segments, if already computed.
 
     Returns
     -------
@@ -370,25 +688,66 @@ def getSlope(lines, angles, zHeads, zTails):
 
     """
 
-    nLines = len(lines)
-
-    # get orthogonal lines
-    orthLines = [rotate(lines[i], -angles[i], use_radians=True) for i in range(nLines)]
+    coords = lineCoords(lines)
 
     # get slope
-    rise = zTails - zHeads
-    run = lines.length
-    if any(run == 0):
+    if lengths is None:
+        lengths = np.linalg.norm(coords[:, 1] - coords[:, 0], axis=1)
+    lengths = np.asarray(lengths, dtype=np.float64)
+    if np.any(lengths == 0):
         raise ValueError("Input `lines` must have positive length.")
-    slope = rise / run
+    slope = (np.asarray(zTails) - np.asarray(zHeads)) / lengths
+
+    # x-coordinates of heads of axis-parallel lines
+    xHeads = _rotate_lines(coords, angles)[:, 0, 0]
 
     # get const s.t. zHeads = const + slope * xHeads
-    xHeads = [line.coords[0][0] for line in orthLines]
     const = zHeads - slope * xHeads
 
     return const, slope
 
 
+def getSlopeArray(zHeads, zTails, lengths, xHeads):
+    """
+    Compute slopes and constants for line-segments from arrays.
+
+    Array-version of ``getSlope`` for when the line lengths and the x-coordinates
+    of the heads of the axis-parallel lines are known, so that no geometry is
+    needed. A line rotated about its midpoint to be axis-parallel has its head
+    at ``xHead = xMid - length / 2``.
+
+    Parameters
+    ----------
+    zHeads : array_like
+        Array of z-coordinates at the heads of the line segments.
+    zTails : array_like
+        Array of z-coordinates at the tails of the line segments.
+    lengths : array_like
+        Array of (2D) lengths of the line segments.
+    xHeads : array_like
+        Array of x-coordinates of the heads of the axis-parallel lines.
+
+    Returns
+    -------
+    const : ndarray
+        Array of intercepts for lines in (x,z)-plane.
+    slope : ndarray
+        Array of slopes for in (x,z)-plane.
+    """
+
+    lengths = np.asarray(lengths, dtype=np.float64)
+    if np.any(lengths == 0):
+        raise ValueError("Input `lengths` must be positive.")
+
+    zHeads = np.asarray(zHeads, dtype=np.float64)
+    slope = (np.asarray(zTails, dtype=np.float64) - zHeads) / lengths
+
+    # get const s.t. zHeads = const + slope * xHeads
+    const = zHeads - slope * np.asarray(xHeads, dtype=np.float64)
+
+    return const, slope
+
+
 def populateRectangle(rectangle, nCols, nRows, decimals=6):
     """
     Populate an x-axis parallel rectangle with a grid of points.
@@ -403,34 +762,57 @@ def populateRectangle(rectangle, nCols, nRows, decimals=6):
         The number of points o y-axis of point grid.
     decimals : number of decimals in point coordinates
         Smaller decimals get rounded, defaults to 6.
+
+    Returns
+    -------
+    points : ndarray
+        Array of ``nCols * nRows`` shapely Points, column by column.
+    """
+
+    return shapely.points(_grid_xy(rectangle, nCols, nRows, decimals))
+
+
+def _grid_xy(rectangle, nCols, nRows, decimals=6):
+    """Coordinates of the ``populateRectangle`` grid as an ``(N, 2)`` array.
+
+    The grid is axis-parallel, so the x-coordinates are those of the columns,
+    each repeated ``nRows`` times, and no meshgrid is needed.
     """
 
     minx, miny, maxx, maxy = rectangle.poly.bounds
 
-    # make grid of points
-    points = []
-    for x in np.linspace(minx, maxx, nCols):
-        for y in np.linspace(miny, maxy, nRows):
-            points.append(Point((round(x, decimals), round(y, decimals))))
+    xs = np.round(np.linspace(minx, maxx, nCols), decimals)
+    ys = np.round(np.linspace(miny, maxy, nRows), decimals)
+
+    coords = np.empty((nCols * nRows, 2), dtype=np.float64)
+    coords[:, 0] = np.repeat(xs, nRows)
+    coords[:, 1] = np.tile(ys, nCols)
 
-    return points
+    return coords
 
 
-def queryRaster(points, rectangle, angle, raster):
+def queryRaster(points, rectangle, angle, raster, method="nearest"):
     """
     Query ``raster`` at given ``points`` belonging to ``rectanlge`` with ``angle``.
     The ``points`` and ``raster`` should be in the same crs.
 
+    The raster window covering all points is read once, and values are
+    interpolated from the in-memory window rather than sampled point by point.
+
     Parameters
     ----------
-    points : list
-        List of coordinates of (grid of) points over rectangle.
+    points : array-like
+        Shapely points of (grid of) points over rectangle, or an array of
+        shape ``(N, 2)`` of their coordinates.
     rectangle : shapely.geometry
         A single rectangle defining the extent of points
     angle : float
         Angle by which rotating rectanlge (anticlockwise) makes it axis parallel.
     raster : rasterio raster
         A raster to sample at points.
+    method : str, optional
+        Interpolation method, either "nearest" (the value of the pixel
+        containing a point, as ``raster.sample``) or "bilinear".
 
     Returns
     -------
@@ -438,24 +820,65 @@ def queryRaster(points, rectangle, angle, raster):
 
     """
 
-    pts = gpd.GeoDataFrame(geometry=points)
+    if method not in ["nearest", "bilinear"]:
+        raise ValueError("The `method` must be either 'nearest' or 'bilinear'")
+
+    coords = np.asarray(points)
+    if coords.dtype == object:
+        coords = shapely.get_coordinates(coords)
 
     # rotate to correct format
-    pts.geometry = pts.geometry.rotate(
-        angle, origin=rectangle.centroid, use_radians=True
-    )
+    cx, cy = rectangle.centroid.coords[0]
+    cos, sin = np.cos(angle), np.sin(angle)
+    dx, dy = coords[:, 0] - cx, coords[:, 1] - cy
+    xs = cx + cos * dx - sin * dy
+    ys = cy + sin * dx + cos * dy
+
+    return _window_values(raster, xs, ys, method)
+
+
+def _window_values(raster, xs, ys, method="nearest"):
+    """Values of ``raster`` at coordinates ``xs, ys``, read in a single window.
+
+    See ``queryRaster`` for the interpolation ``method``. ``raster`` may be an
+    open dataset or a ``rioxarray`` DataArray.
+    """
 
-    coord_list = [(x, y) for x, y in zip(pts["geometry"].x, pts["geometry"].y)]
+    # pad by a pixel, as bilinear interpolation uses neighbouring pixels
+    if _is_dataarray(raster):
+        xres, yres = np.abs(raster.rio.resolution())
+    else:
+        xres, yres = raster.res
+    bounds = (xs.min() - xres, ys.min() - yres, xs.max() + xres, ys.max() + yres)
+    arr, transform = _read_window(raster, bounds)
+    arr = arr.astype(np.float64)
+    height, width = arr.shape
 
-    pts["values"] = [x[0] for x in raster.sample(coord_list)]
+    cols, rows = ~transform * (xs, ys)
 
-    return pts["values"].values
+    if method == "nearest":
+        rows = np.clip(np.floor(rows).astype(int), 0, height - 1)
+        cols = np.clip(np.floor(cols).astype(int), 0, width - 1)
+        return arr[rows, cols]
+
+    # bilinear, between pixel centers
+    rows, cols = rows - 0.5, cols - 0.5
+    r0, c0 = np.floor(rows), np.floor(cols)
+    wr, wc = rows - r0, cols - c0
+    r0 = np.clip(r0.astype(int), 0, height - 1)
+    c0 = np.clip(c0.astype(int), 0, width - 1)
+    r1, c1 = np.minimum(r0 + 1, height - 1), np.minimum(c0 + 1, width - 1)
+
+    top = arr[r0, c0] * (1 - wc) + arr[r0, c1] * wc
+    bottom = arr[r1, c0] * (1 - wc) + arr[r1, c1] * wc
+
+    return top * (1 - wr) + bottom * wr
 
 
 def rasterValues(rectangle, nrows, ncols, rasterfile):
     """Form (nrows x ncols) grid over rectangle and query raster."""
 
-    raster = rio.open(rasterfile)
+    raster = _open_raster(rasterfile)
 
     points = populateRectangle(rectangle, ncols, nrows)
 
@@ -477,16 +900,489 @@ def normalizedRasterValues(rectangle, nrows, ncols, rasterfile):
 
 
 def save_raster_values(rectangle, nrows, ncols, rasterfile, savedir, fmt="%.2e"):
-    """Query distance to LoS place and save file as array."""
+    """Query distance to LoS place and save file as array.
+
+    The array is saved as ``{savedir}/{rectangle.id}.csv`` with values
+    formatted by ``fmt``, or as binary ``{savedir}/{rectangle.id}.npy`` if
+    ``fmt="npy"``.
+    """
+
+    raster = _open_raster(rasterfile)
+
+    # grid coordinates only, no Points are made
+    xy = _grid_xy(rectangle, ncols, nrows)
+
+    vals = queryRaster(xy, rectangle.poly, rectangle.angle, raster)
+
+    vals = rectangle.normalize_raster_values(xy[:, 0], vals)
+
+    arr = vals.reshape((ncols, nrows)).T
+
+    if fmt == "npy":
+        np.save(f"{savedir}/{rectangle.id}.npy", arr)
+        return
+
+    # format all values at once, and write the file in one go
+    rows = np.char.mod(fmt, arr)
+    text = "".join(",".join(row) + "\n" for row in rows)
+
+    Path(f"{savedir}/{rectangle.id}.csv").write_text(text)
+
+
+def init_worker(rasterfile, cachemax=512):
+    """Open ``rasterfile`` once for the current worker process or thread.
+
+    Meant as the ``initializer`` of a ``multiprocessing.Pool``. Raster queries
+    in the worker reuse the open dataset instead of reopening the file, and
+    GDAL's block cache serves repeated reads of the same tiles from memory.
+    This works best with a tiled raster, such as a Cloud-Optimized GeoTIFF.
+
+    Parameters
+    ----------
+    rasterfile : str
+        Filename of raster.
+    cachemax : int
+        Size of the GDAL block cache in megabytes.
+    """
+
+    # a config option, as GDAL reads the environment only once per process
+    rio.env.set_gdal_config("GDAL_CACHEMAX", int(cachemax))
+
+    _open_raster(rasterfile)
+
+
+def _is_dataarray(src):
+    """Whether ``src`` is an xarray DataArray with the ``rioxarray`` accessor."""
+    return hasattr(src, "rio") and hasattr(src, "dims")
+
+
+def _open_raster(rasterfile):
+    """Return an open dataset for ``rasterfile``.
 
-    out = normalizedRasterValues(rectangle, nrows, ncols, rasterfile)
+    ``rasterfile`` may be an open dataset or a ``rioxarray`` DataArray, which
+    are returned as is. Filenames are opened through a least-recently-used
+    cache of up to 256 handles, so repeated queries reuse the open dataset.
+    GDAL handles are not thread-safe, hence each thread has its own cache;
+    handles are closed when evicted or when their thread exits.
+    """
+
+    if isinstance(rasterfile, rio.io.DatasetReader) or _is_dataarray(rasterfile):
+        return rasterfile
+
+    datasets = getattr(_LOCAL, "datasets", None)
+    if datasets is None:
+        datasets = _LOCAL.datasets = OrderedDict()
+
+    src = datasets.pop(rasterfile, None)
+    if src is None or src.closed:
+        src = rio.open(rasterfile)
+
+    # most recently used last
+    datasets[rasterfile] = src
+    while len(datasets) > _MAX_DATASETS:
+        datasets.popitem(last=False)[1].close()
+
+    return src
+
+
+def _forget_datasets():
+    """Drop datasets inherited from the parent in a forked child process."""
+    global _LOCAL
+    _LOCAL = threading.local()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_datasets)
+
+
+def _morton_code(x, y, bits=16):
+    """Interleave the bits of non-negative integer coordinates ``x`` and ``y``."""
+
+    x = np.asarray(x, dtype=np.uint64)
+    y = np.asarray(y, dtype=np.uint64)
+
+    code = np.zeros_like(x)
+    for b in range(bits):
+        code |= ((x >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b)
+        code |= ((y >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b + 1)
+
+    return code
+
+
+def spatial_order(bounds):
+    """Order rectangles such that nearby rectangles are close in the order.
+
+    Rectangles are sorted by the Morton code (Z-order) of their centroids.
+    Consecutive index ranges of the sorted rectangles are thus spatially
+    compact, which keeps the union of their bounds small.
+
+    Parameters
+    ----------
+    bounds : ndarray
+        Array of shape ``(N, 4)`` of axis-parallel rectangle bounds
+        ``(minx, miny, maxx, maxy)``.
+
+    Returns
+    -------
+    order : ndarray
+        Permutation of ``range(N)`` that sorts the rectangles.
+    """
+
+    bounds = np.asarray(bounds, dtype=np.float64)
+    centroids = (bounds[:, :2] + bounds[:, 2:]) / 2
+
+    # quantize centroids to a 2**16 x 2**16 grid over their extent
+    lower = centroids.min(axis=0)
+    extent = centroids.max(axis=0) - lower
+    extent[extent == 0] = 1
+    cells = ((centroids - lower) / extent * (2**16 - 1)).astype(np.uint64)
+
+    return np.argsort(_morton_code(cells[:, 0], cells[:, 1]), kind="stable")
+
+
+def chunk_rectangles(rectangles, size=64):
+    """Group rectangles into chunks of spatially nearby rectangles.
+
+    Rectangles are sorted with ``spatial_order`` and then split into
+    consecutive chunks.
+
+    Parameters
+    ----------
+    rectangles : list or Rectangles
+        List of proppy.Rectangle-objects, or a Rectangles-object.
+    size : int
+        Maximum number of rectangles per chunk.
+
+    Returns
+    -------
+    chunks : list
+        List of lists of proppy.Rectangle-objects, or of Rectangles-objects.
+    """
+
+    if len(rectangles) == 0:
+        return []
+
+    if isinstance(rectangles, Rectangles):
+        order = spatial_order(rectangles.bounds)
+        return [rectangles[order[k : k + size]] for k in range(0, len(order), size)]
+
+    order = spatial_order(np.array([r.poly.bounds for r in rectangles]))
+
+    return [
+        [rectangles[i] for i in order[k : k + size]] for k in range(0, len(order), size)
+    ]
+
+
+@njit(cache=True, nogil=True)
+def _sample_rectangle(bounds, angle, ncols, nrows, decimals, arr, inv_transform):
+    """Sample ``arr`` at the ``populateRectangle`` grid of a rectangle.
+
+    The grid is laid over the axis-parallel ``bounds`` and rotated by
+    ``angle`` about their center, as in ``queryRaster``. Coordinates are then
+    mapped to pixels of ``arr`` with the inverse affine ``inv_transform``.
+
+    Returns
+    -------
+    x : ndarray
+        x-coordinates of the grid points in the axis-parallel frame.
+    vals : ndarray
+        Values of ``arr`` at the grid points.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    cx, cy = (minx + maxx) / 2, (miny + maxy) / 2
+    cos, sin = np.cos(angle), np.sin(angle)
+    a, b, c, d, e, f = inv_transform
+    height, width = arr.shape
+
+    xs = np.linspace(minx, maxx, ncols)
+    ys = np.linspace(miny, maxy, nrows)
+
+    x = np.empty(ncols * nrows)
+    vals = np.empty(ncols * nrows)
+
+    for i in range(ncols):
+        px = round(xs[i], decimals) - cx
+        for j in range(nrows):
+            py = round(ys[j], decimals) - cy
+
+            # rotate into the frame of the raster
+            xr = cx + cos * px - sin * py
+            yr = cy + sin * px + cos * py
+
+            col = min(max(int(np.floor(a * xr + b * yr + c)), 0), width - 1)
+            row = min(max(int(np.floor(d * xr + e * yr + f)), 0), height - 1)
+
+            k = i * nrows + j
+            x[k] = px + cx
+            vals[k] = arr[row, col]
+
+    return x, vals
+
+
+def _rotated_bounds(bounds, angles):
+    """Bounds of the union of rectangles rotated to their original position."""
+
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+    hw = (bounds[:, 2] - bounds[:, 0]) / 2
+    hh = (bounds[:, 3] - bounds[:, 1]) / 2
+
+    # half-extents of the rotated rectangles
+    cos, sin = np.abs(np.cos(angles)), np.abs(np.sin(angles))
+    dx = hw * cos + hh * sin
+    dy = hw * sin + hh * cos
+
+    return (cx - dx).min(), (cy - dy).min(), (cx + dx).max(), (cy + dy).max()
+
+
+def _read_dataarray_window(da, window, fill):
+    """Read ``window`` of a ``rioxarray`` DataArray, padding with ``fill``.
+
+    Only the blocks of a (dask-backed) DataArray that overlap the window are
+    loaded.
+    """
+
+    if "band" in da.dims:
+        da = da.isel(band=0)
+
+    height, width = da.rio.height, da.rio.width
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    r0, r1 = max(row_off, 0), min(row_off + int(window.height), height)
+    c0, c1 = max(col_off, 0), min(col_off + int(window.width), width)
+
+    arr = np.full((int(window.height), int(window.width)), fill, dtype=da.dtype)
+    if r0 < r1 and c0 < c1:
+        sub = da.isel({da.rio.y_dim: slice(r0, r1), da.rio.x_dim: slice(c0, c1)})
+        arr[r0 - row_off : r1 - row_off, c0 - col_off : c1 - col_off] = sub.values
+
+    return arr
+
+
+def _read_dataset_window(src, window, fill):
+    """Read ``window`` of band 1 of a rasterio dataset, padding with ``fill``.
+
+    Only the part of the window on the raster is read; this avoids the much
+    slower boundless read through a VRT.
+    """
+
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    r0, r1 = max(row_off, 0), min(row_off + height, src.height)
+    c0, c1 = max(col_off, 0), min(col_off + width, src.width)
+
+    if (r0, r1, c0, c1) == (row_off, row_off + height, col_off, col_off + width):
+        return src.read(1, window=window)
+
+    arr = np.full((height, width), fill, dtype=src.dtypes[0])
+    if r0 < r1 and c0 < c1:
+        inner = rio.windows.Window(c0, r0, c1 - c0, r1 - r0)
+        arr[r0 - row_off : r1 - row_off, c0 - col_off : c1 - col_off] = src.read(
+            1, window=inner
+        )
+
+    return arr
+
+
+def _read_window(src, bounds):
+    """Read band 1 of ``src`` over ``bounds``, padding with nodata off-raster.
+
+    ``src`` is an open rasterio dataset or a ``rioxarray`` DataArray.
+
+    Returns
+    -------
+    arr : ndarray
+        Raster values in the window.
+    transform : affine.Affine
+        Affine transform of the window.
+    """
+
+    is_dataarray = _is_dataarray(src)
+    transform = src.rio.transform() if is_dataarray else src.transform
+    nodata = src.rio.nodata if is_dataarray else src.nodata
+
+    minx, miny, maxx, maxy = bounds
+    cols, rows = ~transform * (
+        np.array([minx, maxx, minx, maxx]),
+        np.array([miny, miny, maxy, maxy]),
+    )
+
+    row_off, col_off = int(np.floor(rows.min())), int(np.floor(cols.min()))
+    height = int(np.floor(rows.max())) - row_off + 1
+    width = int(np.floor(cols.max())) - col_off + 1
+    window = rio.windows.Window(col_off, row_off, width, height)
+
+    fill = nodata if nodata is not None else 0
+    if is_dataarray:
+        arr = _read_dataarray_window(src, window, fill)
+    else:
+        arr = _read_dataset_window(src, window, fill)
+
+    return arr, rio.windows.transform(window, transform)
+
+
+def _normalize_rectangles(
+    bounds, angles, consts, slopes, ncols, nrows, decimals, arr, inv_transform, out
+):
+    """Write distances to the LoS-plane of each rectangle's grid into ``out``."""
 
-    arr = out["vals"].reshape((ncols, nrows)).T
+    for i in prange(bounds.shape[0]):
+        x, vals = _sample_rectangle(
+            bounds[i], angles[i], ncols, nrows, decimals, arr, inv_transform
+        )
+        for k in range(x.size):
+            out[i, k] = consts[i] + slopes[i] * x[k] - vals[k]
+
+
+# `prange` is a plain `range` in the serial kernel, which releases the GIL for
+# use from thread pools. The parallel kernel runs rectangles on numba threads.
+# Only the serial kernel is cached: numba keys its cache on the function, not
+# on the compile options, so a cached parallel build would be loaded as well.
+_normalize_rectangles_serial = njit(cache=True, nogil=True)(_normalize_rectangles)
+_normalize_rectangles_parallel = njit(parallel=True)(_normalize_rectangles)
 
-    np.savetxt(f"{savedir}/{out['id']}.csv", arr, delimiter=",", fmt=fmt)
 
+def normalized_raster_arrays(
+    bounds, angles, consts, slopes, nrows, ncols, rasterfile, out=None, parallel=False
+):
+    """Query distance to LoS-plane for rectangles given as arrays.
 
-def queryMeanObstruction(rectangle, nRows, distPerCol, rasterfile, fillna=99999):
+    The raster window covering all rectangles is read into memory once. Each
+    grid is then sampled from this in-memory array by a compiled kernel rather
+    than by querying the raster point by point.
+
+    Parameters
+    ----------
+    bounds : ndarray
+        Array of shape ``(N, 4)`` of axis-parallel rectangle bounds
+        ``(minx, miny, maxx, maxy)``, preferably of nearby rectangles,
+        see ``spatial_order``.
+    angles : ndarray
+        Angles for rotating rectangles to original position.
+    consts : ndarray
+        Rectangle z-axis constants.
+    slopes : ndarray
+        Rectangle z-axis slopes.
+    nrows : int
+        Number of rows of grid points per rectangle.
+    ncols : int
+        Number of columns of grid points per rectangle.
+    rasterfile : str, rasterio.io.DatasetReader or xarray.DataArray
+        Filename of raster, an open raster dataset, or a raster opened with
+        ``rioxarray.open_rasterio``. Filenames are opened once per thread, see
+        ``init_worker``. A dask-backed DataArray loads only the chunks that
+        overlap the rectangles.
+    out : ndarray, optional
+        Array of shape ``(N, nrows * ncols)`` to write the result into, e.g.
+        a buffer reused across calls.
+    parallel : bool
+        Whether to process the rectangles in parallel on numba threads. The
+        serial kernel releases the GIL, so leave this off when calling from
+        a thread pool.
+
+    Returns
+    -------
+    vals : ndarray
+        Array of shape ``(N, nrows * ncols)`` of distances to the LoS-plane.
+    """
+
+    bounds = np.asarray(bounds, dtype=np.float64)
+    angles = np.asarray(angles, dtype=np.float64)
+
+    if out is None:
+        out = np.empty((len(bounds), nrows * ncols))
+    if len(bounds) == 0:
+        return out
+
+    src = _open_raster(rasterfile)
+    arr, transform = _read_window(src, _rotated_bounds(bounds, angles))
+
+    inv_transform = np.array((~transform)[:6])
+
+    kernel = (
+        _normalize_rectangles_parallel if parallel else _normalize_rectangles_serial
+    )
+    kernel(
+        bounds,
+        angles,
+        np.asarray(consts, dtype=np.float64),
+        np.asarray(slopes, dtype=np.float64),
+        ncols,
+        nrows,
+        6,
+        arr,
+        inv_transform,
+        out,
+    )
+
+    return out
+
+
+def normalized_raster_values(rectangles, nrows, ncols, rasterfile):
+    """Query distance to LoS-plane for a chunk of rectangles with a single read.
+
+    See ``normalized_raster_arrays``.
+
+    Parameters
+    ----------
+    rectangles : list or Rectangles
+        List of proppy.Rectangle-objects, or a Rectangles-object, preferably
+        spatially close to each other, see ``chunk_rectangles``.
+    nrows : int
+        Number of rows of grid points per rectangle.
+    ncols : int
+        Number of columns of grid points per rectangle.
+    rasterfile : str or rasterio.io.DatasetReader
+        Filename of raster, or an open raster dataset.
+
+    Returns
+    -------
+    out : list
+        List of dicts with the rectangle ``"id"`` and the ``"data"`` array of
+        length ``nrows * ncols`` for each rectangle.
+    """
+
+    rectangles = Rectangles.from_rectangles(rectangles)
+
+    vals = normalized_raster_arrays(
+        rectangles.bounds.reshape(-1, 4),
+        rectangles.angles,
+        rectangles.consts,
+        rectangles.slopes,
+        nrows,
+        ncols,
+        rasterfile,
+    )
+
+    return [{"id": i, "data": v} for i, v in zip(rectangles.ids.tolist(), vals)]
+
+
+def _mean_obstruction(x, raster_vals, const, slope, fillna, nodata_thresh):
+    """Fraction of points below the raster, in a single pass over the points.
+
+    Raster values above ``nodata_thresh`` are replaced with ``fillna``.
+    """
+
+    n = x.size
+    count = 0
+    for i in prange(n):
+        v = fillna if raster_vals[i] > nodata_thresh else raster_vals[i]
+        if const + slope * x[i] - v < 0:
+            count += 1
+
+    return count / n
+
+
+# As for `_normalize_rectangles`, the serial kernel releases the GIL for use
+# from thread pools, and the parallel kernel reduces on numba threads. Only the
+# serial kernel is cached, so it never loads the parallel build from the cache.
+_mean_obstruction_serial = njit(cache=True, nogil=True)(_mean_obstruction)
+_mean_obstruction_parallel = njit(parallel=True)(_mean_obstruction)
+
+
+def queryMeanObstruction(
+    rectangle, nRows, distPerCol, rasterfile, fillna=99999, parallel=False
+):
     """
     Compute mean obstruction of Rectangles-object for given raster.
 
@@ -502,6 +1398,10 @@ def queryMeanObstruction(rectangle, nRows, distPerCol, rasterfile, fillna=99999)
         Filename of raster.
     fillna : float
         Value to replace missing elevation numbers with.
+    parallel : bool
+        Whether to reduce over the grid points on numba threads. The serial
+        kernel releases the GIL, so leave this off when calling from a thread
+        pool.
 
     Notes
     -----
@@ -514,29 +1414,133 @@ def queryMeanObstruction(rectangle, nRows, distPerCol, rasterfile, fillna=99999)
 
     nCols = int(rectangle.length // distPerCol) + 1
 
-    # read raster from file if not already read
-    raster = rio.open(rasterfile)
+    # reuse open raster handle, if any
+    raster = _open_raster(rasterfile)
 
-    # populate rectangle with points
-    pts = populateRectangle(rectangle.poly, nCols, nRows)
-    pts = gpd.GeoDataFrame(geometry=pts)
+    # populate rectangle with grid coordinates
+    xy = _grid_xy(rectangle, nCols, nRows)
 
     # sample raster values at points
-    pts["rasterVal"] = queryRaster(
-        pts.geometry, rectangle.poly, rectangle.angle, raster
+    vals = queryRaster(xy, rectangle.poly, rectangle.angle, raster)
+
+    # missing data (> 3.0e38) is imputed, occurs e.g. when out of bounds
+    kernel = _mean_obstruction_parallel if parallel else _mean_obstruction_serial
+    under = kernel(
+        xy[:, 0],
+        vals,
+        float(rectangle.const),
+        float(rectangle.slope),
+        float(fillna),
+        3.0e38,
     )
 
-    # impute missing data - occurs e.g. when out of bounds
-    pts.loc[pts["rasterVal"] > 3.0e38, "rasterVal"] = fillna
+    return rectangle.id, under
+
+
+def process_rectangles(rectangles, rasterfile, nRows, distPerCol, max_workers=8):
+    """
+    Compute mean obstruction of rectangles in a pool of threads.
+
+    Runs ``queryMeanObstruction`` for each rectangle. Raster reads and the
+    obstruction kernel release the GIL, so threads avoid the process start-up
+    and pickling costs of ``multiprocessing``. Each thread keeps its own open
+    dataset, see ``_open_raster``.
+
+    Parameters
+    ----------
+    rectangles : Rectangles or list
+        A Rectangles-object, or list of proppy.Rectangle-objects.
+    rasterfile: str
+        Filename of raster.
+    nRows : int
+        Number of rows of grid points to query the raster with.
+    distPerCol : int
+        Numbor of distance units for each column of grid points.
+    max_workers : int
+        Number of threads.
+
+    Returns
+    -------
+    results : list
+        List of ``(id, mean obstruction)``-tuples, in order of ``rectangles``.
+    """
 
-    # get rectangle values at points
-    linkConst = rectangle.const
-    linkSlope = rectangle.slope
-    pts["x"] = np.array([p.x for p in pts.geometry])
-    pts["pointVal"] = linkConst + linkSlope * pts["x"]
+    def work(rectangle):
+        return queryMeanObstruction(rectangle, nRows, distPerCol, rasterfile)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(work, rectangles))
+
+
+def batch_mean_obstruction(
+    rectangles, nRows, distPerCol, rasterfile, fillna=99999, method="nearest"
+):
+    """
+    Compute mean obstruction of many rectangles with a single raster read.
+
+    Batch-version of ``queryMeanObstruction``. The grids of all rectangles
+    are made as one array of coordinates, the raster is read once over their
+    union bounding box, and obstruction is averaged per rectangle.
+
+    Parameters
+    ----------
+    rectangles : Rectangles or list
+        A Rectangles-object, or list of proppy.Rectangle-objects. These should
+        be spatially close to each other, see ``chunk_rectangles``, as the
+        raster is read over the bounding box of all rectangles.
+    nRows : int
+        Number of rows of grid points to query the raster with.
+    distPerCol : int
+        Numbor of distance units for each column of grid points.
+    rasterfile: str
+        Filename of raster, an open raster dataset or a ``rioxarray``
+        DataArray.
+    fillna : float
+        Value to replace missing elevation numbers with.
+    method : str, optional
+        Interpolation method, see ``queryRaster``.
+
+    Returns
+    -------
+    fractions : np.array
+        Fraction of obstructed grid points for each rectangle, in order.
+    """
+
+    rectangles = Rectangles.from_rectangles(rectangles)
+    if len(rectangles) == 0:
+        return np.empty(0)
+
+    # grid points per rectangle, as in queryMeanObstruction
+    nCols = (rectangles.lengths // distPerCol).astype(np.int64) + 1
+    counts = nCols * nRows
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # rectangle and grid (column, row) of every point, columns outer
+    rect = np.repeat(np.arange(len(rectangles)), counts)
+    k = np.arange(counts.sum()) - offsets[rect]
+    col, row = k // nRows, k % nRows
+
+    # grid coordinates as in np.linspace, see populateRectangle
+    minx, miny, maxx, maxy = rectangles.bounds.T
+    n = nCols[rect]
+    xstep = (maxx - minx)[rect] / np.maximum(n - 1, 1)
+    x = np.where((col == n - 1) & (n > 1), maxx[rect], minx[rect] + col * xstep)
+    ystep = (maxy - miny)[rect] / max(nRows - 1, 1)
+    y = np.where((row == nRows - 1) & (nRows > 1), maxy[rect], miny[rect] + row * ystep)
+    x, y = np.round(x, 6), np.round(y, 6)
+
+    # rotate about rectangle centers to original position
+    cx, cy = ((minx + maxx) / 2)[rect], ((miny + maxy) / 2)[rect]
+    cos, sin = np.cos(rectangles.angles)[rect], np.sin(rectangles.angles)[rect]
+    xs = cx + cos * (x - cx) - sin * (y - cy)
+    ys = cy + sin * (x - cx) + cos * (y - cy)
+
+    vals = _window_values(_open_raster(rasterfile), xs, ys, method)
+
+    # impute missing data - occurs e.g. when out of bounds
+    vals[vals > 3.0e38] = fillna
 
-    # get distance from ground
-    pts["diff"] = pts["pointVal"] - pts["rasterVal"]
-    pts["under"] = pts["diff"] < 0
+    heights = rectangles.consts[rect] + rectangles.slopes[rect] * x
+    under = heights - vals < 0
 
-    return rectangle.id, pts["under"].mean()
+    return np.add.reduceat(under, offsets) / counts
@@ -6,12 +6,14 @@ shapes
 The `shapes`-submodule helps equip line-segments with variables from shapefiles.
 """
 
+import shapely
+
 
 def cornerCoords(geometry):
     """
     Extract the corner coordinates of a `shapely.geometry`.
 
-    This function covers two cases:  `MultiPolygon` and `Polygon`.
+    Works for any geometry, e.g. `MultiPolygon` and `Polygon`.
 
     Parameters
     ----------
@@ -25,18 +27,4 @@ def cornerCoords(geometry):
         every point in the input `geometry`.
     """
 
-    corners = []
-
-    # loop over geometries `geom` if `MultiPolygon`
-    if isinstance(geometry, shapely.geometry.multipolygon.MultiPolygon):
-        for geom in geometry.boundary.geoms:
-            coords = np.vstack(geom.coords).tolist()
-            for c in coords:
-                corners.append(c)
-    else:
-        # loop over coords only if `Polygon`
-        coords = np.vstack(geometry.boundary.coords).tolist()
-        for c in coords:
-            corners.append(c)
-
-    return corners
+    return shapely.get_coordinates(geometry).tolist()